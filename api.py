@@ -2,21 +2,69 @@
 FastAPI application to expose the receipt processing service as a web API.
 """
 import uvicorn
-import shutil
 import os
+import asyncio
+import logging
+import logging.handlers
+import queue
+from contextlib import asynccontextmanager
 from datetime import datetime
+from typing import Optional
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field
 
 # Import the core processing functions and your Pydantic model
-from receipt_service import get_text_from_receipt, structure_receipt_text, Expenses
-from config import PORT, DEBUG
+from receipt_service import (
+    get_text_from_receipt,
+    get_text_from_receipt_uri,
+    get_texts_from_receipts,
+    normalize_ocr_text,
+    structure_receipt_text,
+    Expenses
+)
+from config import PORT, DEBUG, MAX_UPLOAD_SIZE, MAX_BATCH_FILES, RECEIPT_BUCKET
+
+logger = logging.getLogger(__name__)
+
+# Size of each chunk read from an uploaded file
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+def configure_logging() -> logging.handlers.QueueListener:
+    """
+    Routes root logging through a queue drained by a background thread, so
+    request handlers never block on stream I/O. Called in each worker process
+    (from the app lifespan) so the listener thread exists wherever logs are
+    produced, including under `gunicorn --preload`.
+    """
+    log_queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener.start()
+    return listener
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Sets up logging when a worker starts and flushes it on shutdown."""
+    listener = configure_logging()
+    try:
+        yield
+    finally:
+        # Flushes queued records; handlers are left in place for any late log calls
+        listener.stop()
 
 # Initialize the FastAPI app
 app = FastAPI(
     title="Receipt Processing API",
     description="An API to extract structured expense data from receipt images.",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Configure CORS (Cross-Origin Resource Sharing)
@@ -43,7 +91,6 @@ async def root():
 @app.get("/debug-env", tags=["Debug"])
 async def debug_env():
     """Debug endpoint to check environment variables directly."""
-    import os
     return {
         "GOOGLE_CLOUD_PROJECT_ID": os.getenv("GOOGLE_CLOUD_PROJECT_ID", "NOT_SET"),
         "GOOGLE_CLOUD_PRIVATE_KEY": "SET" if os.getenv("GOOGLE_CLOUD_PRIVATE_KEY") else "NOT_SET",
@@ -58,16 +105,22 @@ async def health_check():
     try:
         # Check if required environment variables are present
         from config import (
-            GOOGLE_API_KEY, 
-            GOOGLE_APPLICATION_CREDENTIALS,
+            google_api_key,
+            HAS_CREDENTIALS_FILE,
             GOOGLE_CLOUD_PROJECT_ID,
             GOOGLE_CLOUD_PRIVATE_KEY,
             GOOGLE_CLOUD_CLIENT_EMAIL
         )
         
+        # Check Gemini API key
+        try:
+            google_ai_configured = bool(google_api_key())
+        except RuntimeError:
+            google_ai_configured = False
+
         # Check Google Vision credentials
         vision_configured = False
-        if GOOGLE_APPLICATION_CREDENTIALS and os.path.exists(GOOGLE_APPLICATION_CREDENTIALS):
+        if HAS_CREDENTIALS_FILE:
             vision_configured = True
         elif all([GOOGLE_CLOUD_PROJECT_ID, GOOGLE_CLOUD_PRIVATE_KEY, GOOGLE_CLOUD_CLIENT_EMAIL]):
             vision_configured = True
@@ -79,13 +132,13 @@ async def health_check():
             "services": {
                 "api": "operational",
                 "google_vision": "operational" if vision_configured else "not_configured",
-                "google_ai": "operational" if GOOGLE_API_KEY else "not_configured"
+                "google_ai": "operational" if google_ai_configured else "not_configured"
             },
             "debug": {
                 "has_project_id": bool(GOOGLE_CLOUD_PROJECT_ID),
                 "has_private_key": bool(GOOGLE_CLOUD_PRIVATE_KEY),
                 "has_client_email": bool(GOOGLE_CLOUD_CLIENT_EMAIL),
-                "has_credentials_file": bool(GOOGLE_APPLICATION_CREDENTIALS and os.path.exists(GOOGLE_APPLICATION_CREDENTIALS))
+                "has_credentials_file": HAS_CREDENTIALS_FILE
             }
         }
             
@@ -98,26 +151,44 @@ async def health_check():
             "error": str(e) if DEBUG else "Health check failed"
         }
 
+class BatchReceiptResult(BaseModel):
+    """Outcome of processing one receipt in a batch request."""
+    filename: Optional[str] = None
+    data: Optional[Expenses] = None
+    error: Optional[str] = None
+
+class ReceiptUriRequest(BaseModel):
+    """A receipt image already uploaded to Google Cloud Storage."""
+    gcs_uri: str = Field(..., description="Location of the image, e.g. gs://bucket/receipt.jpg")
+
+class UploadTooLargeError(HTTPException):
+    """Raised when an uploaded file exceeds MAX_UPLOAD_SIZE."""
+    def __init__(self, filename: Optional[str]):
+        super().__init__(status_code=413, detail=f"Uploaded file {filename} is too large.")
+
+async def read_upload(file: UploadFile) -> bytes:
+    """Reads an upload into memory in chunks, rejecting oversize uploads."""
+    contents = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        contents.extend(chunk)
+        if len(contents) > MAX_UPLOAD_SIZE:
+            raise UploadTooLargeError(file.filename)
+    return bytes(contents)
+
 @app.post("/process-receipt/", response_model=Expenses, tags=["Receipt Processing"])
 async def process_receipt_endpoint(file: UploadFile = File(...)):
     """
     Accepts an uploaded receipt image, performs OCR and LLM structuring,
     and returns the extracted expense data as JSON.
     """
-    # Create a temporary path to save the uploaded file in /tmp (Railway allows writing here)
-    temp_file_path = f"/tmp/temp_{file.filename}"
-    
     try:
-        # Save the uploaded file to disk
-        contents = await file.read()
-        with open(temp_file_path, "wb") as buffer:
-            buffer.write(contents)
+        contents = await read_upload(file)
 
         # --- Step 1: Perform OCR ---
-        raw_text = get_text_from_receipt(temp_file_path)
+        raw_text = await get_text_from_receipt(contents)
         if raw_text is None:
             raise HTTPException(status_code=500, detail="OCR processing failed.")
-        if not raw_text.strip():
+        if not normalize_ocr_text(raw_text):
             raise HTTPException(status_code=400, detail="No text could be found in the image.")
 
         # --- Step 2: Structure Text with LLM ---
@@ -125,25 +196,108 @@ async def process_receipt_endpoint(file: UploadFile = File(...)):
         if not expense_data:
             raise HTTPException(status_code=500, detail="LLM failed to structure the receipt data.")
             
-        # Return the final structured data
-        return expense_data
+        # Return the final structured data, serialized directly with orjson
+        return ORJSONResponse(expense_data.model_dump(mode="json"))
 
+    except HTTPException:
+        raise
     except Exception as e:
         # If any unexpected error occurs, return a generic 500 error
         # In debug mode, we can return the specific error message
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"Error processing receipt: {e}")
-        print(f"Full traceback: {error_details}")
+        logger.exception(f"Error processing receipt: {e}")
         
         detail = str(e)  # Always show the actual error for now
         raise HTTPException(status_code=500, detail=detail)
-    finally:
-        # --- Step 3: Clean up the temporary file ---
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+
+@app.post("/process-receipt-uri/", response_model=Expenses, tags=["Receipt Processing"])
+async def process_receipt_uri_endpoint(body: ReceiptUriRequest):
+    """
+    Accepts the GCS URI of a receipt image uploaded directly by the client,
+    performs OCR and LLM structuring, and returns the extracted expense data as JSON.
+    """
+    # Only read from the configured upload bucket so callers can't OCR arbitrary objects
+    if not RECEIPT_BUCKET:
+        raise HTTPException(status_code=400, detail="Processing receipts from GCS is not enabled.")
+    bucket_prefix = f"gs://{RECEIPT_BUCKET}/"
+    if not body.gcs_uri.startswith(bucket_prefix) or len(body.gcs_uri) == len(bucket_prefix):
+        raise HTTPException(status_code=400, detail=f"gcs_uri must point to an object in {bucket_prefix}")
+
+    try:
+        # --- Step 1: Perform OCR (Vision reads the image from GCS) ---
+        raw_text = await get_text_from_receipt_uri(body.gcs_uri)
+        if raw_text is None:
+            raise HTTPException(status_code=500, detail="OCR processing failed.")
+        if not normalize_ocr_text(raw_text):
+            raise HTTPException(status_code=400, detail="No text could be found in the image.")
+
+        # --- Step 2: Structure Text with LLM ---
+        expense_data = await structure_receipt_text(raw_text)
+        if not expense_data:
+            raise HTTPException(status_code=500, detail="LLM failed to structure the receipt data.")
+
+        return ORJSONResponse(expense_data.model_dump(mode="json"))
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"Error processing receipt from {body.gcs_uri}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/process-receipts-batch/", response_model=list[BatchReceiptResult], tags=["Receipt Processing"])
+async def process_receipts_batch_endpoint(files: list[UploadFile] = File(...)):
+    """
+    Accepts several receipt images, performs OCR on them in batched Vision
+    requests and structures each one with the LLM concurrently.
+    Returns one result per file, in upload order.
+    """
+    # Reject oversized batches before reading any file into memory
+    if len(files) > MAX_BATCH_FILES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Too many files: at most {MAX_BATCH_FILES} receipts per batch."
+        )
+
+    try:
+        # Oversize files get their own error result; the rest of the batch still runs
+        results: list[Optional[BatchReceiptResult]] = [None] * len(files)
+        contents: list[bytes] = []
+        accepted: list[int] = []
+        for i, file in enumerate(files):
+            try:
+                contents.append(await read_upload(file))
+                accepted.append(i)
+            except UploadTooLargeError:
+                results[i] = BatchReceiptResult(error="File too large.")
+
+        # --- Step 1: Perform OCR on all accepted images ---
+        raw_texts = await get_texts_from_receipts(contents)
+
+        # --- Step 2: Structure each text with the LLM concurrently ---
+        async def structure(raw_text: Optional[str]) -> BatchReceiptResult:
+            if raw_text is None:
+                return BatchReceiptResult(error="OCR processing failed.")
+            if not normalize_ocr_text(raw_text):
+                return BatchReceiptResult(error="No text could be found in the image.")
+            expense_data = await structure_receipt_text(raw_text)
+            if not expense_data:
+                return BatchReceiptResult(error="LLM failed to structure the receipt data.")
+            return BatchReceiptResult(data=expense_data)
+
+        structured = await asyncio.gather(*(structure(raw_text) for raw_text in raw_texts))
+        for i, result in zip(accepted, structured):
+            results[i] = result
+        for file, result in zip(files, results):
+            result.filename = file.filename
+        return ORJSONResponse([result.model_dump(mode="json") for result in results])
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"Error processing receipt batch: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
-    # This allows you to run the API directly using `python api.py`
+    # This allows you to run the API directly using `python api.py` for local development.
+    # In production the app is served by Gunicorn with WEB_CONCURRENCY Uvicorn workers (see Dockerfile).
     print(f"Starting API server on http://0.0.0.0:{PORT}")
     uvicorn.run("api:app", host="0.0.0.0", port=PORT, reload=True)
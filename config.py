@@ -1,4 +1,5 @@
 import os
+from functools import lru_cache
 from dotenv import load_dotenv
 
 # Load environment variables from .env
@@ -14,11 +15,17 @@ def get_env_var(name: str) -> str:
         )
     return value
 
-# Example usage
-GOOGLE_API_KEY = get_env_var("GOOGLE_API_KEY")
+# Required vars are read lazily so importing config never fails; a missing
+# value raises on first use instead
+@lru_cache(maxsize=None)
+def google_api_key() -> str:
+    """Google API key for Gemini AI."""
+    return get_env_var("GOOGLE_API_KEY")
 
 # Try to get credentials path, but don't fail if not provided
 GOOGLE_APPLICATION_CREDENTIALS = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+# Checked once at startup since the path is fixed for the process lifetime
+HAS_CREDENTIALS_FILE = bool(GOOGLE_APPLICATION_CREDENTIALS and os.path.exists(GOOGLE_APPLICATION_CREDENTIALS))
 
 # Alternative: Use individual credential environment variables
 GOOGLE_CLOUD_PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT_ID")
@@ -26,16 +33,19 @@ GOOGLE_CLOUD_PRIVATE_KEY = os.getenv("GOOGLE_CLOUD_PRIVATE_KEY")
 GOOGLE_CLOUD_CLIENT_EMAIL = os.getenv("GOOGLE_CLOUD_CLIENT_EMAIL")
 GOOGLE_CLOUD_CLIENT_ID = os.getenv("GOOGLE_CLOUD_CLIENT_ID")
 
-# Debug logging
-import logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-logger.info(f"DEBUG - GOOGLE_CLOUD_PROJECT_ID: {'SET' if GOOGLE_CLOUD_PROJECT_ID else 'NOT SET'}")
-logger.info(f"DEBUG - GOOGLE_CLOUD_PRIVATE_KEY: {'SET' if GOOGLE_CLOUD_PRIVATE_KEY else 'NOT SET'}")
-logger.info(f"DEBUG - GOOGLE_CLOUD_CLIENT_EMAIL: {'SET' if GOOGLE_CLOUD_CLIENT_EMAIL else 'NOT SET'}")
-logger.info(f"DEBUG - GOOGLE_CLOUD_CLIENT_ID: {'SET' if GOOGLE_CLOUD_CLIENT_ID else 'NOT SET'}")
-
 # Optional vars (with defaults)
 DEBUG = os.getenv("DEBUG", "false").lower() == "true"
 PORT = int(os.getenv("PORT", "8000"))
+# Maximum accepted upload size in bytes (default: 10 MB)
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(10 * 1024 * 1024)))
+# GCS bucket clients upload receipts to; /process-receipt-uri/ only reads from this bucket
+RECEIPT_BUCKET = os.getenv("RECEIPT_BUCKET")
+# Maximum number of files accepted by the batch endpoint
+MAX_BATCH_FILES = int(os.getenv("MAX_BATCH_FILES", "16"))
+# Maximum concurrent outbound calls per worker to Vision and the LLM
+OCR_CONCURRENCY = int(os.getenv("OCR_CONCURRENCY", "8"))
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "4"))
+# SQLite file used to cache OCR and LLM results (set empty to disable)
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "/tmp/receipt_cache.db")
+# How long cached results are kept, in seconds (default: 7 days)
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", str(7 * 24 * 60 * 60)))
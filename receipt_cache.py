@@ -0,0 +1,108 @@
+"""
+SQLite-backed cache for OCR and LLM results.
+Entries are keyed by the SHA-256 hash of their input so duplicate uploads skip the API calls.
+"""
+import asyncio
+import hashlib
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from typing import Optional
+
+from config import CACHE_DB_PATH, CACHE_TTL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+OCR_TABLE = "ocr_cache"
+LLM_TABLE = "llm_cache"
+
+# Expired rows are deleted on startup and then once every this many writes
+PRUNE_EVERY_N_WRITES = 100
+
+def content_hash(data: bytes) -> str:
+    """Returns the hex SHA-256 digest used as the cache key."""
+    return hashlib.sha256(data).hexdigest()
+
+def _connect() -> sqlite3.Connection:
+    return sqlite3.connect(CACHE_DB_PATH, timeout=30)
+
+# Cache calls run in the default thread pool, so each pool thread keeps one open connection
+_thread_local = threading.local()
+_write_counter = itertools.count(1)
+
+def _connection() -> sqlite3.Connection:
+    conn = getattr(_thread_local, "conn", None)
+    if conn is None:
+        conn = _thread_local.conn = _connect()
+    return conn
+
+def _oldest_valid_ts() -> int:
+    return int(time.time()) - CACHE_TTL_SECONDS
+
+def _prune(conn: sqlite3.Connection) -> None:
+    """Deletes entries older than CACHE_TTL_SECONDS."""
+    with conn:
+        for table in (OCR_TABLE, LLM_TABLE):
+            conn.execute(f"DELETE FROM {table} WHERE ts < ?", (_oldest_valid_ts(),))
+
+def _init_db() -> bool:
+    """Creates the cache tables, returning False if the cache cannot be used."""
+    if not CACHE_DB_PATH:
+        return False
+    try:
+        with closing(_connect()) as conn:
+            # WAL lets multiple worker processes read while one writes
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                for table in (OCR_TABLE, LLM_TABLE):
+                    conn.execute(
+                        f"CREATE TABLE IF NOT EXISTS {table} "
+                        "(hash TEXT PRIMARY KEY, text TEXT NOT NULL, ts INTEGER NOT NULL)"
+                    )
+                    conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_ts ON {table} (ts)")
+            _prune(conn)
+        return True
+    except sqlite3.Error as e:
+        logger.warning(f"Cache disabled, could not open {CACHE_DB_PATH}: {e}")
+        return False
+
+_CACHE_ENABLED = _init_db()
+
+def _get(table: str, key: str) -> Optional[str]:
+    row = _connection().execute(
+        f"SELECT text FROM {table} WHERE hash = ? AND ts >= ?",
+        (key, _oldest_valid_ts()),
+    ).fetchone()
+    return row[0] if row else None
+
+def _set(table: str, key: str, value: str) -> None:
+    conn = _connection()
+    with conn:
+        conn.execute(
+            f"INSERT OR REPLACE INTO {table} (hash, text, ts) VALUES (?, ?, ?)",
+            (key, value, int(time.time())),
+        )
+    if next(_write_counter) % PRUNE_EVERY_N_WRITES == 0:
+        _prune(conn)
+
+async def get_cached(table: str, key: str) -> Optional[str]:
+    """Looks up a cached value without blocking the event loop."""
+    if not _CACHE_ENABLED:
+        return None
+    try:
+        return await asyncio.to_thread(_get, table, key)
+    except sqlite3.Error as e:
+        logger.warning(f"Cache lookup failed: {e}")
+        return None
+
+async def set_cached(table: str, key: str, value: str) -> None:
+    """Stores a value in the cache without blocking the event loop."""
+    if not _CACHE_ENABLED:
+        return
+    try:
+        await asyncio.to_thread(_set, table, key, value)
+    except sqlite3.Error as e:
+        logger.warning(f"Cache write failed: {e}")
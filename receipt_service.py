@@ -2,11 +2,17 @@
 Core service for processing receipt images.
 Handles OCR and LLM-based data structuring.
 """
-import os
+import re
 import asyncio
+import logging
+from io import BytesIO
+from functools import lru_cache
 from datetime import datetime
 from typing import Union, Optional
 
+# Image processing imports
+from PIL import Image, UnidentifiedImageError
+
 # Pydantic and Pydantic-AI imports
 from pydantic import BaseModel, Field
 from pydantic_ai import Agent
@@ -19,14 +25,26 @@ from google.api_core import exceptions
 
 # Import your configuration
 from config import (
-    GOOGLE_API_KEY, 
+    google_api_key,
     GOOGLE_APPLICATION_CREDENTIALS,
+    HAS_CREDENTIALS_FILE,
     GOOGLE_CLOUD_PROJECT_ID,
     GOOGLE_CLOUD_PRIVATE_KEY,
     GOOGLE_CLOUD_CLIENT_EMAIL,
-    GOOGLE_CLOUD_CLIENT_ID
+    GOOGLE_CLOUD_CLIENT_ID,
+    OCR_CONCURRENCY,
+    LLM_CONCURRENCY
 )
 
+# Import the OCR / LLM result cache
+from receipt_cache import OCR_TABLE, LLM_TABLE, content_hash, get_cached, set_cached
+
+logger = logging.getLogger(__name__)
+
+# Bound the number of in-flight outbound calls to stay within API rate limits
+_OCR_SEM = asyncio.Semaphore(OCR_CONCURRENCY)
+_LLM_SEM = asyncio.Semaphore(LLM_CONCURRENCY)
+
 # --- 1. Define the Structured Output (Your Pydantic Model) ---
 class Expenses(BaseModel):
     amount: float = Field(..., ge=0, description="The total amount of the expense")
@@ -37,99 +55,271 @@ class Expenses(BaseModel):
     subcategory: str = Field(default="", description="The sub-category of the expense")
     paymentMethod: Optional[str] = Field(None, description="The payment method used")
 
-# --- 2. The OCR Function ---
-def get_text_from_receipt(image_path: str) -> Optional[str]:
-    """Uses Google Cloud Vision to perform OCR on a local image file."""
+# --- 2. The Vision Client (created once and reused across requests) ---
+# Keepalive pings hold the gRPC connection open between sparse requests so they
+# don't each pay a fresh TLS handshake; message size limits match the library defaults.
+_GRPC_CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+]
+
+def _create_vision_client(credentials=None) -> vision.ImageAnnotatorAsyncClient:
+    """Creates an async Vision client on a keepalive-tuned gRPC channel."""
+    transport_class = vision.ImageAnnotatorAsyncClient.get_transport_class("grpc_asyncio")
+    channel = transport_class.create_channel(
+        f"{transport_class.DEFAULT_HOST}:443",
+        credentials=credentials,
+        options=_GRPC_CHANNEL_OPTIONS,
+    )
+    return vision.ImageAnnotatorAsyncClient(transport=transport_class(channel=channel))
+
+# The async client is built lazily so its gRPC channel binds to the running event loop.
+# lru_cache does not cache exceptions, so a failed build is retried on the next request.
+@lru_cache(maxsize=1)
+def _build_vision_client() -> vision.ImageAnnotatorAsyncClient:
+    """Builds an async Vision client from whichever credentials are configured."""
+    # Method 1: Use JSON credentials file
+    if HAS_CREDENTIALS_FILE:
+        logger.info(f"Using JSON credentials file: {GOOGLE_APPLICATION_CREDENTIALS}")
+        return _create_vision_client()
+
+    # Method 2: Use individual environment variables
+    elif all([GOOGLE_CLOUD_PROJECT_ID, GOOGLE_CLOUD_PRIVATE_KEY, GOOGLE_CLOUD_CLIENT_EMAIL]):
+        logger.info("Using individual credential environment variables")
+        logger.info(f"Project ID: {GOOGLE_CLOUD_PROJECT_ID}")
+        logger.info(f"Client Email: {GOOGLE_CLOUD_CLIENT_EMAIL}")
+        from google.oauth2 import service_account
+
+        # Create credentials from environment variables
+        # Fix private key format - remove quotes if present and handle line breaks
+        private_key = GOOGLE_CLOUD_PRIVATE_KEY
+        if private_key.startswith('"') and private_key.endswith('"'):
+            private_key = private_key[1:-1]  # Remove surrounding quotes
+        private_key = private_key.replace('\\n', '\n')
+
+        credentials_info = {
+            "type": "service_account",
+            "project_id": GOOGLE_CLOUD_PROJECT_ID,
+            "private_key_id": GOOGLE_CLOUD_CLIENT_ID or "",
+            "private_key": private_key,
+            "client_email": GOOGLE_CLOUD_CLIENT_EMAIL,
+            "client_id": GOOGLE_CLOUD_CLIENT_ID or "",
+            "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+            "token_uri": "https://oauth2.googleapis.com/token",
+            "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
+            "client_x509_cert_url": f"https://www.googleapis.com/robot/v1/metadata/x509/{GOOGLE_CLOUD_CLIENT_EMAIL}"
+        }
+
+        logger.info("Creating credentials from environment variables...")
+        credentials = service_account.Credentials.from_service_account_info(credentials_info)
+        logger.info("Credentials created successfully!")
+
+        logger.info("Creating Vision client...")
+        client = _create_vision_client(credentials)
+        logger.info("Vision client created successfully!")
+        return client
+
+    else:
+        raise RuntimeError(
+            "No valid Google Cloud credentials found. Please set either: "
+            "1. GOOGLE_APPLICATION_CREDENTIALS pointing to a valid JSON file, or "
+            "2. GOOGLE_CLOUD_PROJECT_ID, GOOGLE_CLOUD_PRIVATE_KEY, and GOOGLE_CLOUD_CLIENT_EMAIL"
+        )
+
+def _get_vision_client() -> Optional[vision.ImageAnnotatorAsyncClient]:
+    """Returns the shared Vision client, or None if it cannot be created."""
     try:
-        # Initialize client with different credential methods
-        client = None
-        
-        # Method 1: Use JSON credentials file
-        if GOOGLE_APPLICATION_CREDENTIALS and os.path.exists(GOOGLE_APPLICATION_CREDENTIALS):
-            print(f"Using JSON credentials file: {GOOGLE_APPLICATION_CREDENTIALS}")
-            client = vision.ImageAnnotatorClient()
-        
-        # Method 2: Use individual environment variables
-        elif all([GOOGLE_CLOUD_PROJECT_ID, GOOGLE_CLOUD_PRIVATE_KEY, GOOGLE_CLOUD_CLIENT_EMAIL]):
-            print("Using individual credential environment variables")
-            print(f"Project ID: {GOOGLE_CLOUD_PROJECT_ID}")
-            print(f"Client Email: {GOOGLE_CLOUD_CLIENT_EMAIL}")
-            from google.oauth2 import service_account
-            import json
-            
-            # Create credentials from environment variables
-            # Fix private key format - remove quotes if present and handle line breaks
-            private_key = GOOGLE_CLOUD_PRIVATE_KEY
-            if private_key.startswith('"') and private_key.endswith('"'):
-                private_key = private_key[1:-1]  # Remove surrounding quotes
-            private_key = private_key.replace('\\n', '\n')
-            
-            credentials_info = {
-                "type": "service_account",
-                "project_id": GOOGLE_CLOUD_PROJECT_ID,
-                "private_key_id": GOOGLE_CLOUD_CLIENT_ID or "",
-                "private_key": private_key,
-                "client_email": GOOGLE_CLOUD_CLIENT_EMAIL,
-                "client_id": GOOGLE_CLOUD_CLIENT_ID or "",
-                "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-                "token_uri": "https://oauth2.googleapis.com/token",
-                "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
-                "client_x509_cert_url": f"https://www.googleapis.com/robot/v1/metadata/x509/{GOOGLE_CLOUD_CLIENT_EMAIL}"
-            }
-            
-            print("Creating credentials from environment variables...")
-            try:
-                credentials = service_account.Credentials.from_service_account_info(credentials_info)
-                print("Credentials created successfully!")
-            except Exception as cred_error:
-                print(f"Error creating credentials: {cred_error}")
-                raise cred_error
-                
-            print("Creating Vision client...")
-            try:
-                client = vision.ImageAnnotatorClient(credentials=credentials)
-                print("Vision client created successfully!")
-            except Exception as client_error:
-                print(f"Error creating Vision client: {client_error}")
-                raise client_error
-        
-        else:
-            print("Error: No valid Google Cloud credentials found")
-            print("Please set either:")
-            print("1. GOOGLE_APPLICATION_CREDENTIALS pointing to a valid JSON file, or")
-            print("2. GOOGLE_CLOUD_PROJECT_ID, GOOGLE_CLOUD_PRIVATE_KEY, and GOOGLE_CLOUD_CLIENT_EMAIL")
-            return None
+        return _build_vision_client()
+    except Exception as e:
+        logger.error(f"Error creating Vision client: {e}")
+        return None
+
+# --- 3. The OCR Function ---
+# Vision reads receipt text reliably at this size, so larger images are downscaled first
+MAX_IMAGE_DIMENSION = 1600
+JPEG_QUALITY = 85
+
+def _downscale_image(content: bytes) -> bytes:
+    """Resizes and re-encodes an image as JPEG if it exceeds MAX_IMAGE_DIMENSION."""
+    try:
+        with Image.open(BytesIO(content)) as img:
+            if max(img.size) <= MAX_IMAGE_DIMENSION:
+                return content
+            img.thumbnail((MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION))
+            if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+                # Flatten onto white; transparent pixels are often stored as black,
+                # which would hide dark receipt text once the alpha channel is dropped
+                background = Image.new("RGB", img.size, "white")
+                background.paste(img, mask=img.convert("RGBA").getchannel("A"))
+                img = background
+            elif img.mode != "RGB":
+                img = img.convert("RGB")
+            buffer = BytesIO()
+            img.save(buffer, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError) as e:
+        # Pass images Pillow cannot or will not decode through unchanged and let Vision judge them
+        logger.warning(f"Skipping image downscale: {e}")
+        return content
+    return buffer.getvalue()
 
-        print(f"Reading image from: {image_path}")
-        with open(image_path, "rb") as image_file:
-            content = image_file.read()
+def _text_from_response(response: vision.AnnotateImageResponse) -> str:
+    """Extracts the full OCR text from a Vision response, raising on API errors."""
+    if response.error.message:
+        raise exceptions.GoogleAPICallError(response.error.message)
+    if response.text_annotations:
+        return response.text_annotations[0].description
+    return ""
 
+async def get_text_from_receipt(content: bytes) -> Optional[str]:
+    """Uses Google Cloud Vision to perform OCR on in-memory image bytes."""
+    # Hash off the event loop; hashlib releases the GIL for large buffers
+    cache_key = await asyncio.to_thread(content_hash, content)
+    cached_text = await get_cached(OCR_TABLE, cache_key)
+    if cached_text is not None:
+        logger.info("OCR result served from cache.")
+        return cached_text
+
+    client = _get_vision_client()
+    if client is None:
+        logger.error("Vision client is not configured")
+        return None
+
+    try:
+        content = await asyncio.to_thread(_downscale_image, content)
         image = vision.Image(content=content)
-        print("Sending request to Google Cloud Vision API...")
-        response = client.text_detection(image=image)
+        logger.info("Sending request to Google Cloud Vision API...")
+        async with _OCR_SEM:
+            response = await client.text_detection(image=image)
         
-        if response.error.message:
-            raise exceptions.GoogleAPICallError(response.error.message)
+        text = _text_from_response(response)
+        if text:
+            logger.info("OCR successful.")
+            await set_cached(OCR_TABLE, cache_key, text)
+        else:
+            logger.info("No text found in the image.")
+        return text
 
-        if response.text_annotations:
-            print("OCR successful.")
-            return response.text_annotations[0].description
-        
-        print("No text found in the image.")
-        return ""
+    except Exception as e:
+        logger.exception(f"An unexpected error occurred during OCR: {e}")
+        return None
+
+async def get_text_from_receipt_uri(gcs_uri: str) -> Optional[str]:
+    """
+    Uses Google Cloud Vision to perform OCR on an image already stored in GCS.
+    Vision fetches the object itself, so no image bytes pass through this server.
+    """
+    client = _get_vision_client()
+    if client is None:
+        logger.error("Vision client is not configured")
+        return None
+
+    try:
+        image = vision.Image(source=vision.ImageSource(image_uri=gcs_uri))
+        logger.info(f"Sending request for {gcs_uri} to Google Cloud Vision API...")
+        async with _OCR_SEM:
+            response = await client.text_detection(image=image)
+
+        text = _text_from_response(response)
+        if text:
+            logger.info("OCR successful.")
+        else:
+            logger.info("No text found in the image.")
+        return text
 
     except Exception as e:
-        print(f"An unexpected error occurred during OCR: {e}")
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"Full OCR error traceback: {error_details}")
+        logger.exception(f"An unexpected error occurred during OCR: {e}")
         return None
 
-# --- 3. The LLM Agent for Structuring the Data ---
-async def structure_receipt_text(text: str) -> Optional[Expenses]:
-    """Uses an LLM agent to parse raw text into the Expenses model."""
-    
-    SYSTEM_PROMPT = """
+# Vision accepts at most this many images in a single batch_annotate_images call
+VISION_BATCH_LIMIT = 16
+# Keep each batch request well under Vision's request size limit
+VISION_BATCH_MAX_BYTES = 8 * 1024 * 1024
+
+async def _prepare_image(index: int, content: bytes) -> Optional[bytes]:
+    """Downscales one image for a batch, returning None if it cannot be processed."""
+    try:
+        return await asyncio.to_thread(_downscale_image, content)
+    except Exception as e:
+        logger.error(f"Could not prepare image {index} for OCR: {e}")
+        return None
+
+def _split_batches(images: list[tuple[int, bytes]]) -> list[list[tuple[int, bytes]]]:
+    """Groups images into batches bounded by both image count and total bytes."""
+    batches: list[list[tuple[int, bytes]]] = []
+    current: list[tuple[int, bytes]] = []
+    current_bytes = 0
+    for index, image in images:
+        if current and (
+            len(current) >= VISION_BATCH_LIMIT
+            or current_bytes + len(image) > VISION_BATCH_MAX_BYTES
+        ):
+            batches.append(current)
+            current, current_bytes = [], 0
+        current.append((index, image))
+        current_bytes += len(image)
+    if current:
+        batches.append(current)
+    return batches
+
+async def get_texts_from_receipts(contents: list[bytes]) -> list[Optional[str]]:
+    """
+    Performs OCR on several images using batched Vision requests.
+    Returns one entry per image, None where OCR failed for that image.
+    """
+    cache_keys = await asyncio.to_thread(
+        lambda: [content_hash(content) for content in contents]
+    )
+    results: list[Optional[str]] = list(
+        await asyncio.gather(*(get_cached(OCR_TABLE, key) for key in cache_keys))
+    )
+    pending = [i for i, text in enumerate(results) if text is None]
+    if not pending:
+        logger.info("OCR results served from cache.")
+        return results
+
+    client = _get_vision_client()
+    if client is None:
+        logger.error("Vision client is not configured")
+        return results
+
+    # Images that fail to prepare keep a None result without affecting the rest
+    prepared = await asyncio.gather(*(_prepare_image(i, contents[i]) for i in pending))
+    images = [(i, image) for i, image in zip(pending, prepared) if image is not None]
+
+    async def annotate_batch(batch: list[tuple[int, bytes]]) -> None:
+        requests = [
+            vision.AnnotateImageRequest(
+                image=vision.Image(content=image),
+                features=[vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION)],
+            )
+            for _, image in batch
+        ]
+        try:
+            logger.info(f"Sending batch of {len(requests)} images to Google Cloud Vision API...")
+            async with _OCR_SEM:
+                response = await client.batch_annotate_images(requests=requests)
+        except Exception as e:
+            logger.exception(f"An unexpected error occurred during batch OCR: {e}")
+            return
+
+        for (i, _), image_response in zip(batch, response.responses):
+            try:
+                results[i] = _text_from_response(image_response)
+            except Exception as e:
+                logger.error(f"OCR failed for image {i}: {e}")
+                continue
+            if results[i]:
+                await set_cached(OCR_TABLE, cache_keys[i], results[i])
+
+    await asyncio.gather(*(annotate_batch(batch) for batch in _split_batches(images)))
+    return results
+
+# --- 4. The LLM Agent for Structuring the Data ---
+SYSTEM_PROMPT = """
     You are an expert receipt-parsing AI. Your task is to extract structured data from the raw OCR text of a receipt and format it as a JSON object matching the `Expenses` schema.
 
     **Rules and Heuristics:**
@@ -140,25 +330,59 @@ async def structure_receipt_text(text: str) -> Optional[Expenses]:
     5.  **`description`**: Create a concise summary including the merchant's name and the first few items.
     6.  **`companions`**: This is almost never on a receipt. Leave as an empty list `[]` unless specific names are clearly mentioned.
     """
-    
+
+# The provider, model and agent are created on first use and shared by every request,
+# so the provider's own pooled HTTP client keeps Gemini connections alive between calls
+@lru_cache(maxsize=1)
+def _get_agent() -> Agent:
+    """Builds the receipt-parsing agent, raising if GOOGLE_API_KEY is missing."""
+    provider = GoogleProvider(api_key=google_api_key())
+    model = GoogleModel("gemini-1.5-flash", provider=provider)
+    return Agent(
+        model=model,
+        system_prompt=SYSTEM_PROMPT,
+        output_type=Expenses,
+    )
+
+# OCR text is trimmed before it reaches the LLM since every input token adds latency and cost
+MAX_LLM_INPUT_CHARS = 4000
+_HORIZONTAL_WHITESPACE_RE = re.compile(r"[ \t]+")
+_NON_SPACE_RE = re.compile(r"\S")
+
+def normalize_ocr_text(text: str) -> str:
+    """Collapses whitespace, drops near-empty lines and caps the text length."""
+    lines = []
+    for line in text.splitlines():
+        line = _HORIZONTAL_WHITESPACE_RE.sub(" ", line).strip()
+        if len(_NON_SPACE_RE.findall(line)) >= 2:
+            lines.append(line)
+    return "\n".join(lines)[:MAX_LLM_INPUT_CHARS]
+
+async def structure_receipt_text(text: str) -> Optional[Expenses]:
+    """Uses an LLM agent to parse raw text into the Expenses model."""
     try:
-        provider = GoogleProvider(api_key=GOOGLE_API_KEY)
-        model = GoogleModel("gemini-1.5-flash", provider=provider)
+        text = normalize_ocr_text(text)
+        if not text:
+            # Never prompt (or cache) the LLM with an empty receipt
+            logger.info("No usable text left after normalizing OCR output.")
+            return None
 
-        receipt_parsing_agent = Agent(
-            model=model,
-            system_prompt=SYSTEM_PROMPT,
-            output_type=Expenses,
-        )
+        cache_key = content_hash(text.encode())
+        cached_json = await get_cached(LLM_TABLE, cache_key)
+        if cached_json is not None:
+            logger.info("LLM result served from cache.")
+            return Expenses.model_validate_json(cached_json)
 
-        print("Sending OCR text to LLM for structuring...")
-        agent_result = await receipt_parsing_agent.run(text)
-        print("LLM structuring successful.")
+        logger.info("Sending OCR text to LLM for structuring...")
+        async with _LLM_SEM:
+            agent_result = await _get_agent().run(text)
+        logger.info("LLM structuring successful.")
         
         if agent_result and agent_result.output:
+            await set_cached(LLM_TABLE, cache_key, agent_result.output.model_dump_json())
             return agent_result.output
         return None
 
     except Exception as e:
-        print(f"An unexpected error occurred during LLM processing: {e}")
+        logger.exception(f"An unexpected error occurred during LLM processing: {e}")
         return None